@@ -58,12 +58,15 @@ debug_ui  = debug_app.userInterface
 # debug_app.log('BAM!', adsk.core.LogLevels.InfoLogLevel, adsk.core.LogTypes.ConsoleLogType)
 
 try:
+    import asyncio
+    import collections
+    import concurrent.futures
+    import contextlib
+    import functools
     import hashlib
-    import http.client
-    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
     import importlib
     import importlib.util
-    import io
     import json
     import logging
     import logging.handlers
@@ -74,7 +77,9 @@ try:
     import struct
     import sys
     import threading
+    import time
     import traceback
+    import types
     from typing import Optional
     import urllib.parse
     import base64
@@ -83,6 +88,9 @@ except ModuleNotFoundError:
 
 VERSION = "1.2"
 
+# The directory that this add-in is installed in
+ADDIN_DIR = os.path.dirname(os.path.realpath(__file__))
+
 # asynchronous event that will be used to launch a script inside fusion 360
 RUN_SCRIPT_EVENT = "fusion_idea_addin_run_script"
 # asynchronous event that will be used to ask user's confirmation before launching a script inside fusion 360
@@ -95,13 +103,33 @@ REQUIRE_CONFIRMATION = False
 
 if REQUIRE_CONFIRMATION:
     try:
+        # Prefer cryptography's OpenSSL-backed rsa implementation when it's available, since it's much faster than
+        # the pure python rsa package.
+        # noinspection PyUnresolvedReferences
+        from cryptography.hazmat.primitives import hashes
         # noinspection PyUnresolvedReferences
-        import rsa
-    except ModuleNotFoundError:
-        sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "rsa-4.0-py2.py3-none-any.whl"))
+        from cryptography.hazmat.primitives.asymmetric import padding
         # noinspection PyUnresolvedReferences
-        import rsa
-        del(sys.path[-1])
+        from cryptography.hazmat.primitives.asymmetric import rsa as crypto_rsa
+    except ImportError:
+        crypto_rsa = None
+        try:
+            # noinspection PyUnresolvedReferences
+            import rsa
+        except ModuleNotFoundError:
+            sys.path.append(os.path.join(ADDIN_DIR, "rsa-4.0-py2.py3-none-any.whl"))
+            # noinspection PyUnresolvedReferences
+            import rsa
+            del(sys.path[-1])
+
+try:
+    # orjson is considerably faster than the json module, but isn't part of Fusion's python distribution
+    # noinspection PyUnresolvedReferences
+    import orjson
+
+    json_loads = orjson.loads
+except ModuleNotFoundError:
+    json_loads = json.loads
 
 def app():
     return adsk.core.Application.get()
@@ -109,10 +137,22 @@ def app():
 def ui():
     return app().userInterface
 
+@contextlib.contextmanager
+def sys_path(path):
+    """Temporarily adds path to sys.path, removing it again even if an exception occurs."""
+    sys.path.append(path)
+    try:
+        yield
+    finally:
+        sys.path.remove(path)
+
 logger = logging.getLogger("fusion_idea_addin")
 logger.propagate = False
 
 class AddIn(object):
+    # The maximum number of parsed public keys that are cached
+    MAX_CACHED_PUBKEYS = 128
+
     def __init__(self):
         self._run_script_event_handler: Optional[RunScriptEventHandler] = None
         self._run_script_event: Optional[adsk.core.CustomEvent] = None
@@ -120,19 +160,36 @@ class AddIn(object):
         self._verify_run_script_event: Optional[adsk.core.CustomEvent] = None
         self._error_dialog_event_handler: Optional[ErrorDialogEventHandler] = None
         self._error_dialog_event: Optional[adsk.core.CustomEvent] = None
-        self._http_server: Optional[HTTPServer] = None
+        self._http_server: Optional[RunScriptHTTPServer] = None
         self._ssdpv4_server: Optional[SSDPV4Server] = None
         self._ssdpv6_server: Optional[SSDPV6Server] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
         self._logging_file_handler: Optional[logging.Handler] = None
         self._logging_dialog_handler: Optional[logging.Handler] = None
 
+        # Parsed run requests, waiting for RunScriptEventHandler to run them on Fusion's main thread
+        self._pending_runs = collections.deque()
+        self._pending_runs_lock = threading.Lock()
+
+        # script name -> (base64 encoded script, compiled code) for the most recent run of each script
+        self._script_cache = {}
+
+        # pydevd path -> loaded pydevd_attach_to_process/attach_script module
+        self._attach_scripts = {}
+
         self._trusted_keys = {}
+        self._trusted_keys_lock = threading.Lock()
+
+        # "modulus:exponent" -> (parsed public key, fingerprint)
+        self._pubkey_cache = collections.OrderedDict()
+        self._pubkey_cache_lock = threading.Lock()
 
     def start(self):
         # debug_ui.messageBox("Server Starting")
         try:
             self._logging_file_handler = logging.handlers.RotatingFileHandler(
-                filename=os.path.join(os.path.dirname(os.path.realpath(__file__)), "fusion_idea_addin_log.txt"),
+                filename=os.path.join(ADDIN_DIR, "fusion_idea_addin_log.txt"),
                 maxBytes=2**20,
                 backupCount=1)
             self._logging_file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
@@ -178,58 +235,184 @@ class AddIn(object):
 
             # Run the http server on a random port, to avoid conflicts when multiple instances of Fusion 360 are
             # running.
-            self._http_server = HTTPServer(("localhost", 54321), RunScriptHTTPRequestHandler)
+            self._http_server = RunScriptHTTPServer(("localhost", 54321), RunScriptHTTPRequestHandler)
 
-            http_server_thread = threading.Thread(target=self.run_http_server, daemon=True)
-            http_server_thread.start()
+            logger.debug("starting http server: port=%d", self._http_server.server_port)
 
-            ssdpv4_server_thread = threading.Thread(target=self.run_ssdpv4_server, daemon=True)
-            ssdpv4_server_thread.start()
+            self._ssdpv4_server = self.create_ssdp_server(SSDPV4Server, "ssdp ipv4")
+            self._ssdpv6_server = self.create_ssdp_server(SSDPV6Server, "ssdp ipv6")
+
+            # All servers share a single event loop, running in a single background thread. A selector loop is used
+            # explicitly, because the default proactor loop on Windows doesn't support add_reader or udp endpoints.
+            self._loop = asyncio.SelectorEventLoop()
+            self._loop_thread = threading.Thread(target=self.run_event_loop, daemon=True)
+            self._loop_thread.start()
 
-            ssdpv6_server_thread = threading.Thread(target=self.run_ssdpv6_server, daemon=True)
-            ssdpv6_server_thread.start()
-            
             # debug_ui.messageBox("Server Started")
         except Exception:
             logger.fatal("Error while starting fusion_idea_addin.", exc_info=sys.exc_info())
 
-    def run_http_server(self):
-        logger.debug("starting http server: port=%d" % self._http_server.server_port)
+    def create_ssdp_server(self, server_class, name):
+        logger.debug("starting %s server", name)
         try:
-            with self._http_server:
-                self._http_server.serve_forever()
+            return server_class(self._http_server.server_port)
         except Exception:
-            logger.fatal("Error occurred while starting the http server.", exc_info=sys.exc_info())
+            logger.fatal("Error occurred while starting the %s server.", name, exc_info=sys.exc_info())
+            return None
 
-    def run_ssdpv4_server(self):
-        logger.debug("starting ssdp ipv4 server")
+    def run_event_loop(self):
+        asyncio.set_event_loop(self._loop)
+        transports = []
         try:
-            with SSDPV4Server(self._http_server.server_port) as server:
-                self._ssdpv4_server = server
-                server.serve_forever()
+            if self._http_server:
+                # Accept connections without blocking, so a spurious wakeup can't stall the loop. The accepted
+                # connections are then handled on the http server's worker threads.
+                self._http_server.socket.setblocking(False)
+                self._loop.add_reader(self._http_server.fileno(), self._http_server._handle_request_noblock)
+
+            for server in (self._ssdpv4_server, self._ssdpv6_server):
+                if server:
+                    (transport, _) = self._loop.run_until_complete(self._loop.create_datagram_endpoint(
+                        lambda server=server: SSDPProtocol(server), sock=server.socket))
+                    transports.append(transport)
+
+            self._loop.run_forever()
         except Exception:
-            logger.fatal("Error occurred while starting the ssdpv4 server.", exc_info=sys.exc_info())
+            logger.fatal("Error occurred while running the server event loop.", exc_info=sys.exc_info())
+        finally:
+            for transport in transports:
+                transport.close()
+            # Give the transports a chance to finish closing
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+
+    def queue_run_script(self, run_request: dict):
+        """Queues a parsed run request, and fires the event that will run it on Fusion's main thread."""
+        with self._pending_runs_lock:
+            self._pending_runs.append(run_request)
 
-    def run_ssdpv6_server(self):
-        logger.debug("starting ssdp ipv6 server")
         try:
-            with SSDPV6Server(self._http_server.server_port) as server:
-                self._ssdpv6_server = server
-                server.serve_forever()
+            if not app().fireCustomEvent(RUN_SCRIPT_EVENT, ""):
+                raise Exception("Failed to fire the run script event")
         except Exception:
-            logger.fatal("Error occurred while starting the ssdpv6 server.", exc_info=sys.exc_info())
-
-    def get_trusted_key_nonce(self, key) -> Optional[int]:
-        return self._trusted_keys.get(key)
-
-    def set_trusted_key_nonce(self, key, nonce: int):
-        self._trusted_keys[key] = nonce
+            # Nothing will consume this request, so don't leave it to be picked up by the next event instead
+            with self._pending_runs_lock:
+                for (index, pending_run) in enumerate(self._pending_runs):
+                    if pending_run is run_request:
+                        del self._pending_runs[index]
+                        break
+            raise
+
+    def next_run_script(self) -> Optional[dict]:
+        with self._pending_runs_lock:
+            if self._pending_runs:
+                return self._pending_runs.popleft()
+            return None
+
+    def compile_script(self, script_name: str, encoded_script: str) -> types.CodeType:
+        """Compiles a base64 encoded script, reusing the previous compilation if the script hasn't changed."""
+        cached = self._script_cache.get(script_name)
+        if cached and cached[0] == encoded_script:
+            return cached[1]
+
+        code = compile(base64.b64decode(encoded_script).decode(), "<string>", "exec")
+        self._script_cache[script_name] = (encoded_script, code)
+        return code
+
+    def load_attach_script(self, pydevd_path: str) -> types.ModuleType:
+        attach_script = self._attach_scripts.get(pydevd_path)
+        if attach_script is None:
+            spec = importlib.util.spec_from_file_location(
+                "attach_script", os.path.join(pydevd_path, "pydevd_attach_to_process", "attach_script.py"))
+            attach_script = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(attach_script)
+            self._attach_scripts[pydevd_path] = attach_script
+        return attach_script
+
+    def trust_key(self, key, nonce: int) -> bool:
+        """Atomically marks key as trusted, as of the given nonce.
+
+        Returns False without changing anything if the key is already trusted with the same or a newer nonce, e.g. if
+        a second verification dialog for the same key is confirmed after a newer request was already accepted.
+        """
+        with self._trusted_keys_lock:
+            trusted_nonce = self._trusted_keys.get(key)
+            if trusted_nonce is not None and nonce <= trusted_nonce:
+                return False
+            self._trusted_keys[key] = nonce
+            return True
+
+    def advance_trusted_key_nonce(self, key, nonce: int) -> bool:
+        """Atomically checks that nonce is newer than the last nonce seen for key, and records it.
+
+        Returns False if key isn't trusted yet, and raises a ValueError if the nonce has already been used.
+        """
+        with self._trusted_keys_lock:
+            trusted_nonce = self._trusted_keys.get(key)
+            if trusted_nonce is None:
+                return False
+            if nonce <= trusted_nonce:
+                raise ValueError("Invalid nonce")
+            self._trusted_keys[key] = nonce
+            return True
+
+    def fingerprint(self, pubkey_string: str) -> str:
+        return self._get_cached_public_key(pubkey_string)[1]
+
+    def get_public_key(self, pubkey_string: str):
+        return self._get_cached_public_key(pubkey_string)[0]
+
+    def _get_cached_public_key(self, pubkey_string: str):
+        """Returns the parsed public key and its fingerprint for a "modulus:exponent" public key string."""
+        with self._pubkey_cache_lock:
+            cached = self._pubkey_cache.get(pubkey_string)
+            if cached is not None:
+                self._pubkey_cache.move_to_end(pubkey_string)
+                return cached
+
+        (pubkey_modulus, pubkey_exponent) = pubkey_string.split(":")
+        if crypto_rsa:
+            pubkey = crypto_rsa.RSAPublicNumbers(int(pubkey_exponent), int(pubkey_modulus)).public_key()
+        else:
+            pubkey = rsa.PublicKey(int(pubkey_modulus), int(pubkey_exponent))
+        # The fingerprint has to match the sha1 hash that IDEA/PyCharm shows to the user, so it can't use a different
+        # hash function without also changing the IDE plugin. It's only computed once per key in any case.
+        cached = (pubkey, hashlib.sha1(pubkey_string.encode()).hexdigest())
+        with self._pubkey_cache_lock:
+            self._pubkey_cache[pubkey_string] = cached
+            self._pubkey_cache.move_to_end(pubkey_string)
+            while len(self._pubkey_cache) > self.MAX_CACHED_PUBKEYS:
+                self._pubkey_cache.popitem(last=False)
+        return cached
+
+    def verify_signature(self, pubkey_string: str, message: str, signature: str):
+        """Verifies the signature of the given message, raising an exception if the signature is not valid."""
+        message_bytes = message.encode()
+        pubkey = self.get_public_key(pubkey_string)
+        if crypto_rsa:
+            pubkey.verify(bytes.fromhex(signature), message_bytes, padding.PKCS1v15(), hashes.SHA1())
+        else:
+            # rsa.verify accepts whichever hash the signature names, so pin it to sha1 to match the cryptography path
+            if rsa.verify(message_bytes, bytes.fromhex(signature), pubkey) != "SHA-1":
+                raise rsa.VerificationError("Verification failed")
 
     def stop(self):
         # debug_ui.messageBox("Server Stopping")
+        if self._loop:
+            try:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop_thread.join()
+            except Exception:
+                logger.error("Error while stopping fusion_idea_addin's server event loop.", exc_info=sys.exc_info())
+        self._loop = None
+        self._loop_thread = None
+
+        # Any runs that haven't started by now would otherwise be picked up by unrelated events after a restart
+        with self._pending_runs_lock:
+            self._pending_runs.clear()
+
         if self._http_server:
             try:
-                self._http_server.shutdown()
                 self._http_server.server_close()
             except Exception:
                 logger.error("Error while stopping fusion_idea_addin's HTTP server.", exc_info=sys.exc_info())
@@ -237,7 +420,6 @@ class AddIn(object):
 
         if self._ssdpv4_server:
             try:
-                self._ssdpv4_server.shutdown()
                 self._ssdpv4_server.server_close()
             except Exception:
                 logger.error("Error while stopping fusion_idea_addin's SSDP ipv4 server.", exc_info=sys.exc_info())
@@ -245,7 +427,6 @@ class AddIn(object):
 
         if self._ssdpv6_server:
             try:
-                self._ssdpv6_server.shutdown()
                 self._ssdpv6_server.server_close()
             except Exception:
                 logger.error("Error while stopping fusion_idea_addin's SSDP ipv6 server.", exc_info=sys.exc_info())
@@ -313,11 +494,13 @@ class RunScriptEventHandler(adsk.core.CustomEventHandler):
     # noinspection PyMethodMayBeStatic
     def notify(self, args):
         try:
-            args = json.loads(args.additionalInfo)
+            args = addin.next_run_script()
+            if args is None:
+                logger.debug("Got a run script event with no pending run request.")
+                return
             # debug_ui.messageBox(f"Running script with args {args}")
             stript_name = args.get("script_name")
             params = args.get("params")
-            script_content = base64.b64decode(args.get("script")).decode()
             debug = int(args["debug"])
             pydevd_path = "pydevd_path" #args["pydevd_path"]
 
@@ -328,57 +511,52 @@ class RunScriptEventHandler(adsk.core.CustomEventHandler):
                 logger.warning("No script provided and debugging not requested. There's nothing to do.")
                 return
 
-            sys.path.append(pydevd_path)
-            try:
-                if debug:
-                    sys.path.append(os.path.join(pydevd_path, "pydevd_attach_to_process"))
-                    try:
-                        import attach_script
-                        port = int(args["debug_port"])
-                        logger.debug("Initiating attach on port %d" % port)
-                        attach_script.attach(port, "localhost")
-                        logger.debug("After attach")
-                    except Exception:
-                        logger.fatal("An error occurred while while starting debugger.", exc_info=sys.exc_info())
-                    finally:
-                        del(sys.path[-1])  # pydevd_attach_to_process dir
-
-                if stript_name:
+            with sys_path(pydevd_path):
+                try:
+                    if debug:
+                        try:
+                            attach_script = addin.load_attach_script(pydevd_path)
+                            port = int(args["debug_port"])
+                            logger.debug("Initiating attach on port %d", port)
+                            attach_script.attach(port, "localhost")
+                            logger.debug("After attach")
+                        except Exception:
+                            logger.fatal("An error occurred while while starting debugger.", exc_info=sys.exc_info())
+
+                    if stript_name:
                   
-                    try:
-                        # This mostly mimics the package name that Fusion uses when running the script
-                        module_name = "__main__" + urllib.parse.quote(stript_name.replace('.', '_'))
-
-                        spec = importlib.util.spec_from_loader(module_name, loader=None)
-                        module = importlib.util.module_from_spec(spec)
-
-                        existing_module = sys.modules.get(module_name)
-                        if existing_module and hasattr(existing_module, "stop"):
-                            existing_module.stop({"isApplicationClosing": False})
-
-                        self.unload_submodules(module_name)
-
-                        sys.modules[module_name] = module
-                        # spec.loader.exec_module(module)
-                        logger.debug("Running script")
-                        exec(script_content, module.__dict__)
-                        # TODO: Changed
-                        module.run(params) # ({"isApplicationStartup": False})
-                    except Exception:
-                        logger.fatal("Unhandled exception while importing and running script.",
-                                     exc_info=sys.exc_info())
-            finally:
-                if detach:
-                    try:
-                        import pydevd
-                        logger.debug("Detaching")
-                        pydevd.stoptrace()
-                    except Exception:
-                        logger.error("Error while stopping tracing.", exc_info=sys.exc_info())
+                        try:
+                            # This mostly mimics the package name that Fusion uses when running the script
+                            module_name = "__main__" + urllib.parse.quote(stript_name.replace('.', '_'))
+
+                            spec = importlib.util.spec_from_loader(module_name, loader=None)
+                            module = importlib.util.module_from_spec(spec)
+
+                            existing_module = sys.modules.get(module_name)
+                            if existing_module and hasattr(existing_module, "stop"):
+                                existing_module.stop({"isApplicationClosing": False})
+
+                            self.unload_submodules(module_name)
+
+                            sys.modules[module_name] = module
+                            # spec.loader.exec_module(module)
+                            logger.debug("Running script")
+                            exec(addin.compile_script(stript_name, args.get("script")), module.__dict__)
+                            # TODO: Changed
+                            module.run(params) # ({"isApplicationStartup": False})
+                        except Exception:
+                            logger.fatal("Unhandled exception while importing and running script.",
+                                         exc_info=sys.exc_info())
+                finally:
+                    if detach:
+                        try:
+                            import pydevd
+                            logger.debug("Detaching")
+                            pydevd.stoptrace()
+                        except Exception:
+                            logger.error("Error while stopping tracing.", exc_info=sys.exc_info())
         except Exception:
             logger.fatal("An error occurred while attempting to start script.", exc_info=sys.exc_info())
-        finally:
-            del sys.path[-1]  # The pydevd dir
 
     @staticmethod
     def unload_submodules(module_name):
@@ -400,7 +578,7 @@ class VerifyRunScriptEventHandler(adsk.core.CustomEventHandler):
     # noinspection PyMethodMayBeStatic
     def notify(self, args):
         try:
-            request_json = json.loads(args.additionalInfo)
+            request_json = json_loads(args.additionalInfo)
 
             (return_value, cancelled) = ui().inputBox(
                 "New fusion_idea debugger connection detected.\n"
@@ -415,17 +593,15 @@ class VerifyRunScriptEventHandler(adsk.core.CustomEventHandler):
                 return
 
             pubkey_string = request_json["pubkey_modulus"] + ":" + request_json["pubkey_exponent"]
-
-            sha1 = hashlib.sha1()
-            sha1.update(pubkey_string.encode())
-
-            expected_hash = bytes.hex(sha1.digest())
+            expected_hash = addin.fingerprint(pubkey_string)
 
             if return_value.upper() == expected_hash.upper():
-                inner_request = json.loads(request_json["message"])
-                addin.set_trusted_key_nonce(pubkey_string, inner_request["nonce"])
+                inner_request = json_loads(request_json["message"])
+                if not addin.trust_key(pubkey_string, inner_request["nonce"]):
+                    logger.warning("Ignoring a verified request with a stale nonce.")
+                    return
                 # debug_ui.messageBox("Fire Custom Event {}".format(request_json["message"]))
-                adsk.core.Application.get().fireCustomEvent(RUN_SCRIPT_EVENT, request_json["message"])
+                addin.queue_run_script(inner_request)
             else:
                 ui().messageBox("The public key does not match. Aborting.")
         except Exception:
@@ -452,12 +628,22 @@ class FusionErrorDialogLoggingHandler(logging.Handler):
 class RunScriptHTTPRequestHandler(BaseHTTPRequestHandler):
     """An HTTP request handler that queues an event in the main thread of fusion 360 to run a script."""
 
+    # Drop connections that stall for this many seconds, so an idle client can't hold on to a worker thread forever
+    timeout = 10
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
 
+    def log_request(self, code='-', size='-'):
+        pass
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
     def do_OPTIONS(self):
         self.send_response(200)
         self.end_headers()
@@ -466,37 +652,29 @@ class RunScriptHTTPRequestHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         logger.debug("Got an http request.")
         content_length = int(self.headers["Content-Length"])
-        body = self.rfile.read(content_length).decode()
+        body = self.rfile.read(content_length)
 
         try:
-            request_json = json.loads(body)
+            request_json = json_loads(body)
             # debug_ui.messageBox(f"Received request with body {request_json}")
+            inner_request = request_json["message"]
 
             if REQUIRE_CONFIRMATION:
-                pubkey = rsa.PublicKey(int(request_json["pubkey_modulus"]), int(request_json["pubkey_exponent"]))
                 pubkey_string = request_json["pubkey_modulus"] + ":" + request_json["pubkey_exponent"]
-                rsa.verify(request_json["message"].encode(), bytes.fromhex(request_json["signature"]), pubkey)
+                addin.verify_signature(pubkey_string, request_json["message"], request_json["signature"])
 
-                nonce = addin.get_trusted_key_nonce(pubkey_string)
+                inner_request = json_loads(request_json["message"])
 
-                if nonce is None:
+                if not addin.advance_trusted_key_nonce(pubkey_string, inner_request["nonce"]):
                     self.send_response(200)
                     self.end_headers()
                     self.wfile.write(b"done")
                     self.finish()
-                    adsk.core.Application.get().fireCustomEvent(VERIFY_RUN_SCRIPT_EVENT, json.dumps(request_json))
+                    adsk.core.Application.get().fireCustomEvent(VERIFY_RUN_SCRIPT_EVENT, body.decode())
                     return
 
-                inner_request = json.loads(request_json["message"])
-
-                if inner_request["nonce"] <= nonce:
-                    raise ValueError("Invalid nonce")
-
-                addin.set_trusted_key_nonce(pubkey_string, inner_request["nonce"])
-
             # debug_ui.messageBox("Fire Custom Event 2 {}".format(request_json["message"]))
-            # TODO: Fix
-            adsk.core.Application.get().fireCustomEvent(RUN_SCRIPT_EVENT, json.dumps(request_json["message"]))
+            addin.queue_run_script(inner_request)
             #'{"script":"C:\\\\Users\\\\Administrator\\\\scripts\\\\fusion_script.py", "debug":"0", "nonce":"12345"}')
             
             self.send_response(200)
@@ -505,54 +683,132 @@ class RunScriptHTTPRequestHandler(BaseHTTPRequestHandler):
         except Exception:
             self.send_response(500)
             self.end_headers()
-            self.wfile.write(str(json.loads(body)["message"]).encode() + traceback.format_exc().encode())
-            # self.wfile.write(traceback.format_exc().encode())
+            self.wfile.write(b"error")
             logger.error("An error occurred while handling http request.", exc_info=sys.exc_info())
 
 
+class RunScriptHTTPServer(ThreadingHTTPServer):
+    """An HTTP server that handles requests on a small, bounded pool of worker threads."""
+
+    MAX_WORKERS = 4
+
+    def __init__(self, server_address, request_handler_class):
+        super().__init__(server_address, request_handler_class)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.MAX_WORKERS, thread_name_prefix="fusion_idea_addin_http")
+        # Requests that have been submitted to the executor and haven't finished yet
+        self._pending_requests = set()
+        self._pending_requests_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        future = self._executor.submit(self.process_request_thread, request, client_address)
+        with self._pending_requests_lock:
+            self._pending_requests.add(future)
+        future.add_done_callback(functools.partial(self._request_done, request))
+
+    def _request_done(self, request, future):
+        with self._pending_requests_lock:
+            self._pending_requests.discard(future)
+        if future.cancelled():
+            # The server was closed while the request was still queued, so it will never be handled
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # ThreadPoolExecutor.shutdown's cancel_futures requires python 3.9, so queued requests are cancelled manually.
+        # The futures are copied first, since cancelling one runs _request_done, which needs the lock.
+        with self._pending_requests_lock:
+            pending_requests = list(self._pending_requests)
+        for future in pending_requests:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+
 class SSDPRequestHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
         data = self.request[0].strip()
-        sock = self.request[1]
+        transport = self.request[1]
+
+        logger.debug("got ssdp request:\n%s", data)
+
+        # A full header parse isn't needed, we only care whether the exact header lines we expect are present.
+        header_lines = data.split(b"\r\n")
+
+        if (header_lines[0] == b"M-SEARCH * HTTP/1.1" and
+                b'MAN: "ssdp:discover"' in header_lines and
+                b"ST: fusion_idea:debug" in header_lines):
+            if not self.server.should_respond(self.client_address):
+                return
+            logger.debug("responding to ssdp request: %s", self.client_address)
+            transport.sendto(self.server.response, self.client_address)
+        else:
+            logger.warning("Got an unexpected ssdp request:\n%s", data)
+
+
+class SSDPProtocol(asyncio.DatagramProtocol):
+    """Passes the datagrams received on an ssdp server's socket by the event loop to the server's request handler."""
 
-        logger.log(logging.DEBUG, "got ssdp request:\n%s" % data)
+    def __init__(self, server: "SSDPServer"):
+        self.server = server
+        self.transport: Optional[asyncio.DatagramTransport] = None
 
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
         try:
-            request_line, headers_text = data.split(b"\r\n", 1)
-            headers = http.client.parse_headers(io.BytesIO(headers_text))
+            # The handler replies through the transport, in place of the socket that socketserver would give it
+            self.server.finish_request((data, self.transport), addr)
         except Exception:
-            logger.error("An error occurred while parsing ssdp request:\n%s" % data,
-                         exc_info=sys.exc_info())
-            return
+            self.server.handle_error((data, self.transport), addr)
 
-        if (request_line == b"M-SEARCH * HTTP/1.1" and
-                headers["MAN"] == '"ssdp:discover"' and
-                headers["ST"] == "fusion_idea:debug"):
-            response = ("HTTP/1.1 200 OK\r\n"
-                        "ST: fusion_idea:debug\r\n"
-                        "USN: pid:%(pid)d\r\n"
-                        "SERVER: fusion_idea/" + VERSION + "\r\n"
-                        "Location: 127.0.0.1:%(debug_port)d\r\n\r\n") % {
-                           "pid": os.getpid(),
-                           "debug_port": self.server.debug_port}
-
-            logger.debug("responding to ssdp request: %s" % str(self.client_address))
-            sock.sendto(response.encode("utf-8"), self.client_address)
-        else:
-            logger.warning("Got an unexpected ssdp request:\n%s" % data)
 
+class SSDPServer(socketserver.UDPServer):
+    """The common base of the ipv4 and ipv6 ssdp servers."""
+
+    # Repeated requests from the same address within this many seconds are ignored
+    RESPONSE_INTERVAL = 2.0
+    # Expired response times are pruned once there are more than this many addresses being tracked
+    MAX_TRACKED_ADDRESSES = 64
+
+    def __init__(self, debug_port):
+        self._last_response = {}
+        self.debug_port = debug_port
+        self.allow_reuse_address = True
+        # The response never changes for the lifetime of the server, so it's only built once
+        self.response = (("HTTP/1.1 200 OK\r\n"
+                          "ST: fusion_idea:debug\r\n"
+                          "USN: pid:%(pid)d\r\n"
+                          "SERVER: fusion_idea/" + VERSION + "\r\n"
+                          "Location: 127.0.0.1:%(debug_port)d\r\n\r\n") % {
+                             "pid": os.getpid(),
+                             "debug_port": debug_port}).encode("utf-8")
+        super().__init__(("", 1900), SSDPRequestHandler)
 
-class SSDPV6Server(socketserver.UDPServer):
+    def should_respond(self, client_address) -> bool:
+        now = time.monotonic()
+        if now - self._last_response.get(client_address, -self.RESPONSE_INTERVAL) < self.RESPONSE_INTERVAL:
+            return False
+
+        if len(self._last_response) >= self.MAX_TRACKED_ADDRESSES:
+            self._last_response = {address: last for (address, last) in self._last_response.items()
+                                   if now - last < self.RESPONSE_INTERVAL}
+        self._last_response[client_address] = now
+        return True
+
+    def handle_error(self, request, client_address):
+        logger.error("An error occurred while processing ssdp request.", exc_info=sys.exc_info())
+
+
+class SSDPV6Server(SSDPServer):
 
     # Random "interface local" multicast address
     MULTICAST_ADDR = "ff01:fb68:e6b7:45f9:4acc:2559:6c6e:c014"
 
     def __init__(self, debug_port):
-        self.debug_port = debug_port
-        self.allow_reuse_address = True
         self.address_family = socket.AF_INET6
-        super().__init__(("", 1900), SSDPRequestHandler)
+        super().__init__(debug_port)
 
     def server_bind(self):
         # debug_ui.messageBox(f"Superbind")
@@ -591,27 +847,20 @@ class SSDPV6Server(socketserver.UDPServer):
             req = struct.pack("=16si", socket.inet_pton(socket.AF_INET6, self.MULTICAST_ADDR), socket.INADDR_ANY)
             self.socket.setsockopt(IPPROTO_V6, socket.IPV6_JOIN_GROUP, req)
 
-    def handle_error(self, request, client_address):
-        logger.error("An error occurred while processing ssdp request.", exc_info=sys.exc_info())
-
 
-class SSDPV4Server(socketserver.UDPServer):
+class SSDPV4Server(SSDPServer):
 
     # Random address in the "administrative" block
     MULTICAST_GROUP = "239.172.243.75"
 
-    def __init__(self, debug_port):
-        self.debug_port = debug_port
-        self.allow_reuse_address = True
-        super().__init__(("", 1900), SSDPRequestHandler)
-
     def server_bind(self):
         super().server_bind()
         req = struct.pack("=4s4s", socket.inet_aton(self.MULTICAST_GROUP), socket.inet_aton("127.0.0.1"))
         self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, req)
-
-    def handle_error(self, request, client_address):
-        logger.error("An error occurred while processing ssdp request.", exc_info=sys.exc_info())
+        # Never let anything multicast from this socket leave the local host.
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        # Note that IP_MULTICAST_LOOP is intentionally left enabled. On Windows it applies to the receiving socket, and
+        # disabling it would drop the IDE's search requests, which are always sent from the local host.
 
 
 addin = AddIn()